@@ -92,9 +92,12 @@ for org in org_to_projects:
         continue
     project_list_name = gh_org_to_project_list_name[org]
     project_list_id = site.get_or_create_project_list(project_list_name)
+    projects_to_move = []
     for project in org_to_projects[org]:
         if project.is_protoproject:
             print('Unable to add project to project list since it is a protoproject. %s' % project)
             continue
-        site.load_into_project_list(project_list_id, [project.key])
-        site.unfollow_repository(project)
+        projects_to_move.append(project)
+    if projects_to_move:
+        site.load_into_project_list(project_list_id, [project.key for project in projects_to_move])
+        site.unfollow_repository_batch(projects_to_move)
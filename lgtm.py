@@ -1,74 +1,189 @@
-from dataclasses import dataclass
-from typing import Optional, List, Dict, Callable
-
-import requests
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Callable, Tuple, DefaultDict
+
+import json
+import logging
+import httpx
 import yaml
+import random
 import time
 
-from requests.exceptions import SSLError
+from utils.rate_limiter import RateLimiter
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 needs the optional `h2` package (`pip install httpx[http2]`); without it httpx stays on HTTP/1.1.
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+# Kept below the connection pool size so every worker can hold its own connection.
+_MAX_WORKERS = 8
+
+_CLIENT_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+_CLIENT_TIMEOUT = httpx.Timeout(30.0)
+
+# Separate limiter for the public API so bulk id lookups are paced like the authenticated calls.
+_public_rate_limiter = RateLimiter(rate=5.0, burst=5)
+
+# Shared client for the unauthenticated public API so repeated lookups reuse the same connection.
+_public_client = httpx.Client(
+    http2=_HTTP2,
+    limits=_CLIENT_LIMITS,
+    timeout=_CLIENT_TIMEOUT,
+    follow_redirects=True
+)
+
+_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Responses that mean the server did not process the request, so even non-idempotent requests can be resent.
+_NOT_PROCESSED_STATUS_CODES = {429, 503}
+_MAX_RETRY_DELAY = 30.0
+
+# How long a getMyProjects response is reused before it is fetched again.
+_PROJECTS_TTL = 30.0
+
+_GITHUB_URL_PREFIX = 'https://github.com/'
+
+_LGTM_INTERNAL_API = 'https://lgtm.com/internal_api/v0.2/'
+_GET_MY_PROJECTS_URL = _LGTM_INTERNAL_API + 'getMyProjects'
+_UPDATE_PROJECT_SELECTION_URL = _LGTM_INTERNAL_API + 'updateProjectSelection'
+_REBUILD_PROTOPROJECT_URL = _LGTM_INTERNAL_API + 'rebuildProtoproject'
+_FOLLOW_PROJECT_URL = _LGTM_INTERNAL_API + 'followProject'
+_UNFOLLOW_PROJECT_URL = _LGTM_INTERNAL_API + 'unfollowProject'
+_UNFOLLOW_PROTOPROJECT_URL = _LGTM_INTERNAL_API + 'unfollowProtoproject'
+_GET_USED_PROJECT_SELECTIONS_URL = _LGTM_INTERNAL_API + 'getUsedProjectSelections'
+_CREATE_PROJECT_SELECTION_URL = _LGTM_INTERNAL_API + 'createProjectSelection'
+_PUBLIC_PROJECTS_URL = 'https://lgtm.com/api/v1.0/projects/g/'
+
+
+def _backoff_delay(attempt: int) -> float:
+    """
+    Exponential backoff with up to 50% jitter so concurrent workers don't retry in lockstep.
+    """
+    return min(_MAX_RETRY_DELAY, (2 ** attempt) * (1 + random.random() * 0.5))
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    try:
+        return min(_MAX_RETRY_DELAY, float(response.headers['Retry-After']))
+    except (KeyError, ValueError):
+        return None
 
 
 class LGTMRequestException(Exception):
     pass
 
 
-@dataclass
+@dataclass(slots=True)
 class LGTMSite:
     nonce: str
     long_session: str
     short_session: str
     api_version: str
-
-    def _cookies(self):
-        return {
+    _cookie_dict: Dict[str, str] = field(init=False, repr=False, compare=False)
+    _header_dict: Dict[str, str] = field(init=False, repr=False, compare=False)
+    _api_data: Dict[str, str] = field(init=False, repr=False, compare=False)
+    _projects_url: str = field(init=False, repr=False, compare=False)
+    _client: httpx.Client = field(init=False, repr=False, compare=False)
+    _projects_cache: Optional[Tuple[float, List[dict]]] = field(init=False, repr=False, compare=False)
+    _org_to_ids_cache: Optional[Tuple[float, Dict[str, List['SimpleProject']]]] = \
+        field(init=False, repr=False, compare=False)
+    _project_lists_cache: Optional[Dict[str, int]] = field(init=False, repr=False, compare=False)
+    _rate_limiter: RateLimiter = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._cookie_dict = {
             'lgtm_long_session': self.long_session,
             'lgtm_short_session': self.short_session
         }
-
-    def _headers(self):
-        return {
+        self._header_dict = {
             'LGTM-Nonce': self.nonce
         }
+        self._api_data = {
+            'apiVersion': self.api_version
+        }
+        self._projects_url = _GET_MY_PROJECTS_URL + '?apiVersion=' + self.api_version
+        self._client = httpx.Client(
+            http2=_HTTP2,
+            limits=_CLIENT_LIMITS,
+            timeout=_CLIENT_TIMEOUT,
+            follow_redirects=True,
+            cookies=self._cookie_dict,
+            headers=self._header_dict
+        )
+        self._projects_cache = None
+        self._org_to_ids_cache = None
+        self._project_lists_cache = None
+        self._rate_limiter = RateLimiter(rate=5.0, burst=5)
 
     def _make_lgtm_get(self, url: str) -> dict:
-        r = LGTMSite._resilient_request(lambda: requests.get(
-            url,
-            cookies=self._cookies(),
-            headers=self._headers()
-        ))
-        return r.json()
+        r = LGTMSite._resilient_request(lambda: self._client.get(url), self._rate_limiter)
+        return json_loads(r.content)
 
     def get_my_projects(self) -> List[dict]:
-        url = 'https://lgtm.com/internal_api/v0.2/getMyProjects?apiVersion=' + self.api_version
+        return self._get_my_projects_cached()[1]
+
+    def _get_my_projects_cached(self) -> Tuple[float, List[dict]]:
+        cached = self._projects_cache
+        if cached is not None and time.monotonic() - cached[0] < _PROJECTS_TTL:
+            return cached
+        url = self._projects_url
         data = self._make_lgtm_get(url)
         if data['status'] == 'success':
-            return data['data']
+            cached = (time.monotonic(), data['data'])
+            self._projects_cache = cached
+            return cached
         else:
             raise LGTMRequestException('LGTM GET request failed with response: %s' % str(data))
 
+    def invalidate_projects(self):
+        """
+        Drops the cached :func:`get_my_projects` response. Called after any request that changes the followed projects.
+        """
+        self._projects_cache = None
+        self._org_to_ids_cache = None
+
+    def _get_my_projects_by_org(self) -> Dict[str, List['SimpleProject']]:
+        fetched_at, projects = self._get_my_projects_cached()
+        cached = self._org_to_ids_cache
+        if cached is not None and cached[0] == fetched_at:
+            return cached[1]
+        org_to_ids = LGTMDataFilters.org_to_ids(projects)
+        self._org_to_ids_cache = (fetched_at, org_to_ids)
+        return org_to_ids
+
     def get_my_projects_under_org(self, org: str) -> List['SimpleProject']:
-        projects_sorted = LGTMDataFilters.org_to_ids(self.get_my_projects())
-        return LGTMDataFilters.extract_project_under_org(org, projects_sorted)
+        return LGTMDataFilters.extract_project_under_org(org, self._get_my_projects_by_org())
 
     def _make_lgtm_post(self, url: str, data: dict, retry_count: int = 0) -> dict:
-        api_data = {
-            'apiVersion': self.api_version
-        }
-        full_data = {**api_data, **data}
-        print(data)
-        r = LGTMSite._resilient_request(lambda: requests.post(
-            url,
-            full_data,
-            cookies=self._cookies(),
-            headers=self._headers()
-        ))
+        full_data = {**self._api_data, **data}
+        logger.debug('POST %s payload=%r', url, data)
+        r = LGTMSite._resilient_request(
+            lambda: self._client.post(url, data=full_data),
+            self._rate_limiter,
+            idempotent=False
+        )
         try:
-            data_returned = r.json()
+            data_returned = json_loads(r.content)
         except ValueError as e:
             response_text = r.text
             raise LGTMRequestException(f'Failed to parse JSON. Response was: {response_text}') from e
 
-        print(data_returned)
+        logger.debug('response=%r', data_returned)
         if data_returned['status'] == 'success':
             if 'data' in data_returned:
                 return data_returned['data']
@@ -78,77 +193,94 @@ class LGTMSite:
             raise LGTMRequestException('LGTM POST request failed with response: %s' % str(data_returned))
 
     def load_into_project_list(self, into_project: int, lgtm_project_ids: List[str]):
-        url = "https://lgtm.com/internal_api/v0.2/updateProjectSelection"
-        # Because LGTM uses some wacky format for it's application/x-www-form-urlencoded data
-        list_serialized = ', '.join([('"' + str(elem) + '"') for elem in lgtm_project_ids])
+        url = _UPDATE_PROJECT_SELECTION_URL
+        # Because LGTM expects JSON arrays of string ids inside of it's application/x-www-form-urlencoded data
         data = {
             'projectSelectionId': into_project,
-            'addedProjects': '[' + list_serialized + ']',
-            'removedProjects': '[]',
+            'addedProjects': json.dumps([str(elem) for elem in lgtm_project_ids]),
+            'removedProjects': json.dumps([]),
         }
         self._make_lgtm_post(url, data)
 
     def force_rebuild_all_proto_projects(self):
-        org_to_projects = LGTMDataFilters.org_to_ids(self.get_my_projects())
-        for org in org_to_projects:
-            for project in org_to_projects[org]:
-                if not project.is_protoproject:
-                    continue
-
-                time.sleep(1)
-                self.force_rebuild_project(project)
+        org_to_projects = self._get_my_projects_by_org()
+        protoprojects = [
+            project
+            for projects in org_to_projects.values()
+            for project in projects
+            if project.is_protoproject
+        ]
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+            list(executor.map(self.force_rebuild_project, protoprojects))
 
     def force_rebuild_project(self, simple_project: 'SimpleProject'):
-        url = 'https://lgtm.com/internal_api/v0.2/rebuildProtoproject'
+        url = _REBUILD_PROTOPROJECT_URL
         data = {
             **simple_project.make_post_data(),
             'config': ''
         }
         try:
             self._make_lgtm_post(url, data)
+            self.invalidate_projects()
         except LGTMRequestException:
             print('Failed rebuilding project. This may be because it is already being built. `%s`' % simple_project)
 
     def follow_repository(self, repository_url: str):
-        url = "https://lgtm.com/internal_api/v0.2/followProject"
+        url = _FOLLOW_PROJECT_URL
         data = {
             'url': repository_url,
             'apiVersion': self.api_version
         }
         self._make_lgtm_post(url, data)
+        self.invalidate_projects()
 
     def unfollow_repository_by_id(self, project_id: str):
-        url = "https://lgtm.com/internal_api/v0.2/unfollowProject"
+        url = _UNFOLLOW_PROJECT_URL
         data = {
             'project_key': project_id,
         }
         self._make_lgtm_post(url, data)
+        self.invalidate_projects()
 
     def unfollow_repository(self, simple_project: 'SimpleProject'):
-        url = "https://lgtm.com/internal_api/v0.2/unfollowProject" if not simple_project.is_protoproject \
-            else "https://lgtm.com/internal_api/v0.2/unfollowProtoproject"
+        url = _UNFOLLOW_PROTOPROJECT_URL if simple_project.is_protoproject else _UNFOLLOW_PROJECT_URL
         data = simple_project.make_post_data()
         self._make_lgtm_post(url, data)
+        self.invalidate_projects()
 
     def unfollow_repository_by_org(self, org: str, include_protoproject: bool = False):
         projects_under_org = self.get_my_projects_under_org(org)
+        to_unfollow = []
         for project in projects_under_org:
             if not include_protoproject and project.is_protoproject:
                 print("Not unfollowing project since it is a protoproject. %s" % project)
                 continue
             print('Unfollowing project %s' % project.display_name)
-            self.unfollow_repository(project)
+            to_unfollow.append(project)
+        self.unfollow_repository_batch(to_unfollow)
+
+    def unfollow_repository_batch(self, simple_projects: List['SimpleProject']):
+        """
+        Unfollows all of the given projects concurrently.
+        LGTM has no bulk unfollow endpoint (`updateProjectSelection` only edits project lists),
+        so the individual unfollow requests are fanned out over a thread pool instead.
+        """
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+            list(executor.map(self.unfollow_repository, simple_projects))
 
     def get_project_lists(self):
-        url = 'https://lgtm.com/internal_api/v0.2/getUsedProjectSelections'
+        url = _GET_USED_PROJECT_SELECTIONS_URL
         return self._make_lgtm_post(url, {})
 
+    def _get_project_lists_by_name(self) -> Dict[str, int]:
+        if self._project_lists_cache is None:
+            self._project_lists_cache = {
+                project_list['name']: int(project_list['key']) for project_list in self.get_project_lists()
+            }
+        return self._project_lists_cache
+
     def get_project_list_by_name(self, list_name: str) -> Optional[int]:
-        project_lists = self.get_project_lists()
-        for project_list in project_lists:
-            if project_list['name'] == list_name:
-                return int(project_list['key'])
-        return None
+        return self._get_project_lists_by_name().get(list_name)
 
     def get_or_create_project_list(self, list_name: str) -> int:
         project_list_id = self.get_project_list_by_name(list_name)
@@ -164,12 +296,15 @@ class LGTMSite:
         :param name: Name of the project list to create.
         :return: The key id for this project.
         """
-        url = 'https://lgtm.com/internal_api/v0.2/createProjectSelection'
+        url = _CREATE_PROJECT_SELECTION_URL
         data = {
             'name': name
         }
         response = self._make_lgtm_post(url, data)
-        return int(response['key'])
+        project_list_id = int(response['key'])
+        if self._project_lists_cache is not None:
+            self._project_lists_cache[name] = project_list_id
+        return project_list_id
 
     def add_org_to_project_list_by_list_key(self, org: str, project_list_key: int):
         projects_under_org = self.get_my_projects_under_org(org)
@@ -183,32 +318,92 @@ class LGTMSite:
         pass
 
     @staticmethod
-    def _resilient_request(request_method: Callable[[], requests.Response], retry_count: int = 0):
-        try:
-            return request_method()
-        except SSLError as e:
-            if retry_count < 4:
-                return LGTMSite._resilient_request(request_method, retry_count + 1)
-            raise LGTMRequestException(f'SSL Error') from e
+    def _resilient_request(
+            request_method: Callable[[], httpx.Response],
+            rate_limiter: Optional[RateLimiter] = None,
+            max_attempts: int = 3,
+            idempotent: bool = True):
+        """
+        :param idempotent: When `False` only failures to connect and 429/503 responses are retried. Any other
+            transport error or 5xx may have happened after the server already acted on the request.
+        """
+        for attempt in range(max_attempts):
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            try:
+                response = request_method()
+            except httpx.TransportError as e:
+                retryable = idempotent or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if not retryable or attempt + 1 == max_attempts:
+                    raise LGTMRequestException(f'Request failed after {max_attempts} attempts') from e
+                time.sleep(_backoff_delay(attempt))
+                continue
+            if rate_limiter is not None:
+                if response.status_code == 429:
+                    rate_limiter.decrease()
+                elif response.status_code < 400:
+                    rate_limiter.increase()
+            retry_codes = _RETRY_STATUS_CODES if idempotent else _NOT_PROCESSED_STATUS_CODES
+            if response.status_code not in retry_codes:
+                if not idempotent and response.status_code >= 500:
+                    raise LGTMRequestException(f'Request failed with HTTP {response.status_code}')
+                return response
+            if attempt + 1 == max_attempts:
+                raise LGTMRequestException(
+                    f'Request failed with HTTP {response.status_code} after {max_attempts} attempts'
+                )
+            time.sleep(_retry_after(response) or _backoff_delay(attempt))
+
+    @staticmethod
+    def _get_public_project(gh_project_path: str) -> httpx.Response:
+        url = _PUBLIC_PROJECTS_URL + gh_project_path
+        return LGTMSite._resilient_request(lambda: _public_client.get(url), _public_rate_limiter)
 
     @staticmethod
     def retrieve_project(gh_project_path: str):
-        url = "https://lgtm.com/api/v1.0/projects/g/" + gh_project_path
-        r = LGTMSite._resilient_request(lambda: requests.get(url))
-        return r.json()
+        r = LGTMSite._get_public_project(gh_project_path)
+        return json_loads(r.content)
 
     @staticmethod
     def retrieve_project_id(gh_project_path: str) -> Optional[int]:
-        data_returned = LGTMSite.retrieve_project(gh_project_path)
+        r = LGTMSite._get_public_project(gh_project_path)
+        if r.status_code == 404:
+            return None
+        if not r.is_success:
+            raise LGTMRequestException(f'Failed to retrieve {gh_project_path}: HTTP {r.status_code}')
+        data_returned = json_loads(r.content)
         if 'id' in data_returned:
             return int(data_returned["id"])
         else:
             return None
 
+    @staticmethod
+    def retrieve_project_id_batch(gh_project_paths: List[str]) -> Dict[str, Optional[int]]:
+        """
+        Looks up the LGTM ids of many GitHub projects concurrently.
+
+        :return: Mapping of each given project path to its LGTM id, or `None` if LGTM doesn't know the project.
+            Paths whose lookup failed are printed and left out of the mapping.
+        """
+        def lookup(gh_project_path: str) -> Tuple[str, Optional[int], Optional[LGTMRequestException]]:
+            try:
+                return gh_project_path, LGTMSite.retrieve_project_id(gh_project_path), None
+            except LGTMRequestException as e:
+                return gh_project_path, None, e
+
+        project_ids: Dict[str, Optional[int]] = {}
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+            for gh_project_path, the_id, error in executor.map(lookup, gh_project_paths):
+                if error is not None:
+                    print('Failed to retrieve project id for %s: %s' % (gh_project_path, error))
+                    continue
+                project_ids[gh_project_path] = the_id
+        return project_ids
+
     @staticmethod
     def create_from_file() -> 'LGTMSite':
         with open("config.yml") as config_file:
-            config = yaml.safe_load(config_file)
+            config = yaml.load(config_file, Loader=SafeLoader)
             lgtm: dict = config['lgtm']
             return LGTMSite(
                 nonce=lgtm['nonce'],
@@ -218,7 +413,7 @@ class LGTMSite:
             )
 
 
-@dataclass
+@dataclass(slots=True)
 class SimpleProject:
     display_name: str
     key: str
@@ -239,47 +434,34 @@ class LGTMDataFilters:
         Converts the output from :func:`~lgtm.LGTMSite.get_my_projects` into a dic of GH org
         to list of projects including their GH id and LGTM id.
         """
-        org_to_ids = {}
+        org_to_ids: DefaultDict[str, List[SimpleProject]] = defaultdict(list)
         for project in projects:
-            org: str
-            display_name: str
-            key: str
-            is_protoproject: bool
-            if 'protoproject' in project:
-                the_project = project['protoproject']
-                if 'https://github.com/' not in the_project['cloneUrl']:
+            protoproject = project.get('protoproject')
+            real_projects = project.get('realProject')
+            if protoproject is not None:
+                if _GITHUB_URL_PREFIX not in protoproject['cloneUrl']:
                     # Not really concerned with BitBucket right now
                     continue
-                display_name = the_project['displayName']
-                org = display_name.split('/')[0]
-                key = the_project['key']
-                is_protoproject = True
-            elif 'realProject' in project:
-
-                the_project = project['realProject'][0]
+                display_name: str = protoproject['displayName']
+                org_to_ids[display_name.split('/')[0]].append(SimpleProject(
+                    display_name=display_name,
+                    key=protoproject['key'],
+                    is_protoproject=True
+                ))
+            elif real_projects is not None:
+                the_project = real_projects[0]
                 if the_project['repoProvider'] != 'github_apps':
                     # Not really concerned with BitBucket right now
                     continue
-                org = str(the_project['slug']).split('/')[1]
-                display_name = the_project['displayName']
-                key = the_project['key']
-                is_protoproject = False
+                org_to_ids[str(the_project['slug']).split('/')[1]].append(SimpleProject(
+                    display_name=the_project['displayName'],
+                    key=the_project['key'],
+                    is_protoproject=False
+                ))
             else:
                 raise KeyError('\'realProject\' nor \'protoproject\' in %s' % str(project))
 
-            ids_list: List[SimpleProject]
-            if org in org_to_ids:
-                ids_list = org_to_ids[org]
-            else:
-                ids_list = []
-                org_to_ids[org] = ids_list
-            ids_list.append(SimpleProject(
-                display_name=display_name,
-                key=key,
-                is_protoproject=is_protoproject
-            ))
-
-        return org_to_ids
+        return dict(org_to_ids)
 
     @staticmethod
     def extract_project_under_org(org: str, projects_sorted: Dict[str, List[SimpleProject]]) -> List[SimpleProject]:
@@ -15,11 +15,13 @@ def main():
 
     project_list_id = site.get_or_create_project_list(args.list_name)
 
-    ids = []
+    gh_project_paths = []
     for line in args.in_file:
         line_clean: str = line.strip()
-        gh_project_path = line_clean.lstrip('https://github.com/')
-        the_id = LGTMSite.retrieve_project_id(gh_project_path)
+        gh_project_paths.append(line_clean.lstrip('https://github.com/'))
+
+    ids = []
+    for gh_project_path, the_id in LGTMSite.retrieve_project_id_batch(gh_project_paths).items():
         if the_id is not None:
             print('Loaded: %s' % gh_project_path)
             ids.append(str(the_id))
@@ -1,8 +1,13 @@
 from github import Github
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 def create() -> Github:
     with open("config.yml") as config_file:
-        config = yaml.safe_load(config_file)
+        config = yaml.load(config_file, Loader=SafeLoader)
         github: dict = config['github']
         return Github(github['api_key'])
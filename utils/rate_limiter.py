@@ -0,0 +1,37 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Thread safe token bucket whose rate adapts to the server: halved whenever we get throttled
+    and stepped back up towards the configured maximum as requests succeed.
+    """
+
+    def __init__(self, rate: float, burst: int, min_rate: float = 0.5):
+        self._max_rate = rate
+        self._min_rate = min_rate
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            # Reserve a token even when the bucket is empty so waiting callers are served in order.
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+    def decrease(self):
+        with self._lock:
+            self._rate = max(self._min_rate, self._rate / 2)
+
+    def increase(self):
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + self._max_rate / 10)